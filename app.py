@@ -1,10 +1,14 @@
 import streamlit as st
+import hashlib
+import io
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from document_processor import process_document, extract_document_text
 from legal_ner import extract_legal_entities
-from vector_store import create_document_embeddings, perform_document_search
-from chatbot import get_chatbot_response
+from vector_store import create_document_embeddings, perform_document_search, serialize_embeddings, deserialize_embeddings
+from chatbot import stream_chatbot_response
+from embedding_cache import get_query_embedding, get_cache_stats
 from database import setup_database, save_document, save_entities, save_chat_interaction, get_document_by_id, list_documents, delete_document
 import utils
 
@@ -13,18 +17,27 @@ st.set_page_config(page_title="Legal Document Analyzer",
                    page_icon="⚖️",
                    layout="wide")
 
-# Cleanup temp directory at startup
-temp_dir = "temp"
-if os.path.exists(temp_dir):
-    try:
-        shutil.rmtree(temp_dir)
-    except Exception as e:
-        st.error(f"Error cleaning temp directory: {e}")
-os.makedirs(temp_dir, exist_ok=True)
+# Cleanup temp directory once per process start, not on every re-run —
+# Streamlit re-executes this script on each widget event and wiping temp/
+# repeatedly races with anything still using it (like the embedding cache)
+@st.cache_resource
+def cleanup_temp_once():
+    shutil.rmtree("temp", ignore_errors=True)
+    os.makedirs("temp", exist_ok=True)
+    return True
+
+cleanup_temp_once()
+
+# Initialize database once per process; st.cache_resource keeps the DDL
+# from re-running on every widget interaction, since Streamlit re-executes
+# the whole script on each one
+@st.cache_resource
+def init_database():
+    setup_database()
+    return True
 
-# Initialize database
 try:
-    setup_database()
+    init_database()
 except Exception as e:
     st.error(f"Error setting up database: {e}")
 
@@ -42,6 +55,18 @@ if "document_embeddings" not in st.session_state:
 if "current_document_id" not in st.session_state:
     st.session_state.current_document_id = None
 
+# Streamlit re-runs the whole script on every widget event, so memoize the
+# expensive analysis steps by document hash; re-analyzing the same text
+# returns instantly. The underscore prefix stops Streamlit from hashing the
+# full document text — the SHA-256 already identifies it.
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_document_analysis(text_hash, _text):
+    return process_document(_text)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_legal_entities(text_hash, _text):
+    return extract_legal_entities(_text)
+
 # Title and description
 st.title("AI-Powered Legal Document Analyzer")
 st.write("""
@@ -62,10 +87,6 @@ with tab1:
     if uploaded_file is not None:
         with st.spinner("Processing document..."):
             try:
-                # Create a temporary file with explicit permissions
-                # Make sure the temporary directory exists with proper permissions
-                os.makedirs("temp", exist_ok=True)
-
                 # Get file details for debugging
                 file_details = {
                     "FileName": uploaded_file.name,
@@ -74,15 +95,11 @@ with tab1:
                 }
                 st.write(f"File details: {file_details}")
 
-                # Save the file to our own temp directory instead of using tempfile
-                temp_path = os.path.join("temp", uploaded_file.name)
-                with open(temp_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-
-                st.success(f"File saved successfully to {temp_path}")
-
-                # Extract text from document
-                document_text = extract_document_text(temp_path)
+                # Extract text straight from the in-memory upload instead of
+                # writing it to a temp file and reading it back
+                document_text = extract_document_text(
+                    io.BytesIO(uploaded_file.getbuffer()),
+                    filename=uploaded_file.name)
                 st.session_state.document_text = document_text
 
                 st.info(
@@ -97,22 +114,37 @@ with tab1:
             if st.button("Analyze Document"):
                 try:
                     with st.spinner("Analyzing document with AI..."):
-                        # Process document with LLM
-                        analysis_results = process_document(document_text)
+                        # The LLM analysis, entity extraction and embedding
+                        # steps are independent, so run them concurrently.
+                        # A thread pool suits the mix here: the API calls
+                        # are I/O-bound and spaCy's NER releases the GIL in
+                        # its C extensions, so they genuinely overlap.
+                        doc_hash = hashlib.sha256(
+                            document_text.encode()).hexdigest()
+
+                        with ThreadPoolExecutor(max_workers=3) as executor:
+                            analysis_future = executor.submit(
+                                cached_document_analysis, doc_hash,
+                                document_text)
+                            entities_future = executor.submit(
+                                cached_legal_entities, doc_hash,
+                                document_text)
+                            embeddings_future = executor.submit(
+                                create_document_embeddings, document_text)
+
+                            analysis_results = analysis_future.result()
+                            entities = entities_future.result()
+                            embeddings = embeddings_future.result()
                         st.session_state.document_analysis = analysis_results
-
-                        # Extract entities
-                        entities = extract_legal_entities(document_text)
                         st.session_state.entities = entities
-
-                        # Create embeddings for search
-                        embeddings = create_document_embeddings(document_text)
                         st.session_state.document_embeddings = embeddings
 
-                        # Save to database
-                        document_id = save_document(uploaded_file.name,
-                                                    document_text,
-                                                    analysis_results)
+                        # Save to database, embeddings included, so reloading
+                        # the document later skips re-embedding it
+                        document_id = save_document(
+                            uploaded_file.name, document_text,
+                            analysis_results,
+                            serialize_embeddings(embeddings))
                         if document_id:
                             st.session_state.current_document_id = document_id
                             # Save entities to database
@@ -151,9 +183,11 @@ with tab1:
                             entity_values) in enumerate(entity_types.items()):
                         col_idx = i % 3
                         with entity_columns[col_idx]:
-                            st.write(f"**{entity_type}**")
-                            for value in entity_values:
-                                st.write(f"- {value}")
+                            # Emit one markdown element per entity group
+                            # instead of one frontend message per entity
+                            listing = "\n".join(
+                                f"- {value}" for value in entity_values)
+                            st.markdown(f"**{entity_type}**\n{listing}")
 
                     # Display highlighted document
                     st.subheader("Document with Highlighted Entities")
@@ -183,21 +217,39 @@ with tab2:
 
             # Get response from chatbot
             with st.spinner("Generating response..."):
+                # Scope the semantic cache to the active document: the
+                # database ID when the document is saved, otherwise a hash
+                # of its text. Without this, switching documents could
+                # serve a cached answer from the previous one.
+                document_key = st.session_state.current_document_id
+                if document_key is None:
+                    document_key = hashlib.sha256(
+                        st.session_state.document_text.encode()).hexdigest()
+
                 if st.session_state.document_embeddings:
+                    # Embed the query through the LRU cache so repeated
+                    # questions skip the embedding API round-trip
+                    query_embedding = get_query_embedding(user_question)
+
                     # Get relevant document context
                     context = perform_document_search(
                         user_question, st.session_state.document_embeddings,
-                        st.session_state.document_text)
-
-                    # Get response from chatbot with context
-                    response = get_chatbot_response(
-                        user_question, context,
-                        st.session_state.document_analysis)
+                        st.session_state.document_text,
+                        query_embedding=query_embedding)
+
+                    # Stream response from chatbot with context
+                    response = st.write_stream(
+                        stream_chatbot_response(
+                            user_question, context,
+                            st.session_state.document_analysis,
+                            document_key=document_key))
                 else:
-                    # Get response from chatbot without context
-                    response = get_chatbot_response(
-                        user_question, st.session_state.document_text,
-                        st.session_state.document_analysis)
+                    # Stream response from chatbot without context
+                    response = st.write_stream(
+                        stream_chatbot_response(
+                            user_question, st.session_state.document_text,
+                            st.session_state.document_analysis,
+                            document_key=document_key))
 
                 # Add response to chat history
                 st.session_state.chat_history.append({
@@ -251,7 +303,8 @@ with tab3:
                     if st.button(f"Load Document #{doc['id']}",
                                  key=f"load_{doc['id']}"):
                         # Load document from database
-                        full_doc = get_document_by_id(doc['id'])
+                        full_doc = get_document_by_id(doc['id'],
+                                                      include_text=True)
                         if full_doc:
                             # Update session state
                             st.session_state.document_text = full_doc[
@@ -276,9 +329,16 @@ with tab3:
                             } for entity in full_doc['entities']]
                             st.session_state.entities = entities
 
-                            # Create new embeddings for the document
-                            embeddings = create_document_embeddings(
-                                full_doc['document_text'])
+                            # Rehydrate stored embeddings; only recompute if
+                            # the document predates embedding persistence
+                            embeddings = None
+                            if full_doc.get('embeddings'):
+                                embeddings = deserialize_embeddings(
+                                    bytes(full_doc['embeddings']),
+                                    full_doc['document_text'])
+                            if embeddings is None:
+                                embeddings = create_document_embeddings(
+                                    full_doc['document_text'])
                             st.session_state.document_embeddings = embeddings
 
                             st.success(
@@ -306,6 +366,12 @@ with tab3:
     except Exception as e:
         st.error(f"Error loading documents from database: {e}")
 
+# Sidebar cache statistics
+cache_stats = get_cache_stats()
+st.sidebar.caption(
+    f"Query embedding cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses"
+)
+
 # Footer
 st.markdown("---")
 st.markdown("Powered by OpenAI GPT-4o and LangChain")
@@ -1,55 +1,136 @@
 import os
+import threading
+import httpx
+import numpy as np
 from openai import OpenAI
 
+from embedding_cache import get_query_embedding
+from utils import truncate_to_tokens
+
 # Initialize OpenAI client
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-openai = OpenAI(api_key=OPENAI_API_KEY)
 
-def get_chatbot_response(question, context, document_analysis=None):
+# Shared HTTP client with HTTP/2 and a persistent connection pool, so
+# repeated chat calls reuse connections instead of re-doing TLS handshakes
+_http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+)
+openai = OpenAI(api_key=OPENAI_API_KEY, http_client=_http_client)
+
+# Semantic cache of past (document key, query embedding, response) entries
+# so near-duplicate questions ("What is the term?" vs "Tell me the term")
+# skip the LLM call. Entries are scoped by document key: answers come from a
+# specific document's context, so a similar question asked against a
+# different document must never be served from another document's cache.
+# Token budget for the document context packed into each prompt
+CONTEXT_TOKEN_BUDGET = 3000
+
+SEMANTIC_CACHE_THRESHOLD = 0.93
+SEMANTIC_CACHE_MAX_SIZE = 128
+_sem_cache = []
+_sem_cache_lock = threading.Lock()
+
+def _check_semantic_cache(document_key, query_embedding):
+    """Return a cached response for this document whose query is similar enough, or None"""
+    with _sem_cache_lock:
+        # Only entries for the same document are candidates
+        candidates = [(position, entry) for position, entry in enumerate(_sem_cache)
+                      if entry[0] == document_key]
+        if not candidates:
+            return None
+        matrix = np.array([entry[1] for _, entry in candidates])
+        # Embeddings are unit-norm, so the dot product is the cosine similarity
+        similarities = matrix @ query_embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+            # Move the hit to the end so eviction drops the least recently used
+            position, entry = candidates[best]
+            _sem_cache.pop(position)
+            _sem_cache.append(entry)
+            return entry[2]
+        return None
+
+def _store_in_semantic_cache(document_key, query_embedding, response):
+    """Store a (document key, query embedding, response) entry, evicting the oldest when full"""
+    with _sem_cache_lock:
+        if len(_sem_cache) >= SEMANTIC_CACHE_MAX_SIZE:
+            _sem_cache.pop(0)
+        _sem_cache.append((document_key, query_embedding, response))
+
+def _build_prompt(question, context, document_analysis=None):
     """
-    Get response from chatbot using OpenAI API with document context
+    Construct the user prompt from the document context and analysis
     """
-    # Prepare document information
+    # Prepare document information. The analysis doesn't change between chat
+    # turns, so the serialized string is cached on the analysis dict and
+    # reused instead of re-parsing the JSON and rebuilding it every turn.
     doc_info = ""
     if document_analysis:
-        doc_type = document_analysis.get("document_type", "")
-        key_info = document_analysis.get("key_information", {})
-        
-        if doc_type:
-            import json
-            doc_type_info = json.loads(doc_type) if isinstance(doc_type, str) else doc_type
-            doc_info += f"Document Type: {doc_type_info.get('document_type', '')}\n"
-            doc_info += f"Document Type Explanation: {doc_type_info.get('explanation', '')}\n\n"
-        
-        if key_info:
-            doc_info += "Document Key Information:\n"
-            for key, value in key_info.items():
-                if isinstance(value, str):
-                    doc_info += f"- {key}: {value}\n"
-                elif isinstance(value, dict):
-                    doc_info += f"- {key}:\n"
-                    for sub_key, sub_value in value.items():
-                        doc_info += f"  - {sub_key}: {sub_value}\n"
+        if "_doc_info_str" in document_analysis:
+            doc_info = document_analysis["_doc_info_str"]
+        else:
+            doc_type = document_analysis.get("document_type", "")
+            key_info = document_analysis.get("key_information", {})
+
+            if doc_type:
+                import json
+                doc_type_info = json.loads(doc_type) if isinstance(doc_type, str) else doc_type
+                doc_info += f"Document Type: {doc_type_info.get('document_type', '')}\n"
+                doc_info += f"Document Type Explanation: {doc_type_info.get('explanation', '')}\n\n"
+
+            if key_info:
+                doc_info += "Document Key Information:\n"
+                for key, value in key_info.items():
+                    if isinstance(value, str):
+                        doc_info += f"- {key}: {value}\n"
+                    elif isinstance(value, dict):
+                        doc_info += f"- {key}:\n"
+                        for sub_key, sub_value in value.items():
+                            doc_info += f"  - {sub_key}: {sub_value}\n"
+
+            document_analysis["_doc_info_str"] = doc_info
     
-    # Construct prompt with context
+    # Cap the context so long documents don't blow up input-token cost; the
+    # retrieved chunks are ordered by relevance, so the tail is the least
+    # valuable part to lose
+    context = truncate_to_tokens(context, CONTEXT_TOKEN_BUDGET)
+
+    # Construct prompt with context. The assistant preamble lives in the
+    # system message, so it isn't repeated here.
     prompt = f"""
-    You are a legal assistant specializing in document analysis and legal research.
-    
     Document Context:
     {context}
-    
+
     {doc_info}
-    
+
     User Question: {question}
-    
+
     Please provide a detailed and accurate response to the user's question based on the document context.
     If the answer cannot be determined from the provided context, acknowledge this limitation and provide
     general legal information that might still be helpful. Cite specific sections or clauses from the
     document when relevant.
     """
-    
+    return prompt
+
+def get_chatbot_response(question, context, document_analysis=None,
+                         document_key=None):
+    """
+    Get response from chatbot using OpenAI API with document context. The
+    semantic cache is only consulted when the caller identifies the active
+    document via document_key.
+    """
+    # Check the semantic cache before paying for a full LLM round-trip
+    query_embedding = np.array(get_query_embedding(question), dtype='float32')
+    if document_key is not None:
+        cached_response = _check_semantic_cache(document_key, query_embedding)
+        if cached_response is not None:
+            return cached_response
+
+    prompt = _build_prompt(question, context, document_analysis)
+
     # Get response from OpenAI
     response = openai.chat.completions.create(
         model="gpt-4o",
@@ -60,8 +141,51 @@ def get_chatbot_response(question, context, document_analysis=None):
         temperature=0.2,
         max_tokens=1000
     )
-    
-    return response.choices[0].message.content
+
+    answer = response.choices[0].message.content
+    if document_key is not None:
+        _store_in_semantic_cache(document_key, query_embedding, answer)
+    return answer
+
+def stream_chatbot_response(question, context, document_analysis=None,
+                            document_key=None):
+    """
+    Stream the chatbot response, yielding text deltas as they arrive so the
+    UI can render tokens immediately instead of waiting for the full answer.
+    The semantic cache is only consulted when the caller identifies the
+    active document via document_key.
+    """
+    # Semantic cache hits are yielded whole
+    query_embedding = np.array(get_query_embedding(question), dtype='float32')
+    if document_key is not None:
+        cached_response = _check_semantic_cache(document_key, query_embedding)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+    prompt = _build_prompt(question, context, document_analysis)
+
+    stream = openai.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "You are a legal assistant specializing in document analysis and legal research. Provide clear, accurate and helpful responses to questions about legal documents."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2,
+        max_tokens=1000,
+        stream=True
+    )
+
+    collected = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            collected.append(delta)
+            yield delta
+
+    if document_key is not None:
+        _store_in_semantic_cache(document_key, query_embedding,
+                                 "".join(collected))
 
 def get_legal_information(query):
     """
@@ -1,274 +1,371 @@
+import csv
+import io
 import os
-import json
+import weakref
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import pool
+from psycopg2.extras import RealDictCursor, Json, execute_values
 from datetime import datetime
+from contextlib import contextmanager
 
-# Get database connection details from environment variables
-def get_db_connection():
-    """Create a connection to the PostgreSQL database"""
-    conn = psycopg2.connect(
-        host=os.environ.get("PGHOST"),
-        database=os.environ.get("PGDATABASE"),
-        user=os.environ.get("PGUSER"),
-        password=os.environ.get("PGPASSWORD"),
-        port=os.environ.get("PGPORT")
-    )
-    return conn
+# Shared connection pool. Borrowing a pooled connection skips the
+# TCP+TLS+auth handshake a fresh connect pays on every call and bounds the
+# number of server-side connections.
+_POOL = None
 
-def setup_database():
-    """Create necessary tables if they don't exist"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def _get_pool():
+    """Create the connection pool on first use"""
+    global _POOL
+    if _POOL is None:
+        _POOL = pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=16,
+            host=os.environ.get("PGHOST"),
+            database=os.environ.get("PGDATABASE"),
+            user=os.environ.get("PGUSER"),
+            password=os.environ.get("PGPASSWORD"),
+            port=os.environ.get("PGPORT")
+        )
+    return _POOL
+
+@contextmanager
+def get_conn():
+    """Borrow a connection from the pool and return it when done"""
+    connection_pool = _get_pool()
+    conn = connection_pool.getconn()
     try:
-        print("Setting up database tables...")
-        
-        # Create documents table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS documents (
-                id SERIAL PRIMARY KEY,
-                filename TEXT NOT NULL,
-                document_type TEXT,
-                upload_date TIMESTAMP NOT NULL,
-                document_text TEXT NOT NULL,
-                summary TEXT,
-                key_information JSONB
-            )
-        ''')
-        print("Created documents table")
-        
-        # Create entities table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS entities (
-                id SERIAL PRIMARY KEY,
-                document_id INTEGER NOT NULL,
-                entity_text TEXT NOT NULL,
-                entity_type TEXT NOT NULL,
-                start_pos INTEGER,
-                end_pos INTEGER,
-                FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
-            )
-        ''')
-        print("Created entities table")
-        
-        # Create chat_history table
+        yield conn
+    finally:
+        connection_pool.putconn(conn)
+
+# Connections that already carry the PREPAREd hot-path statements.
+# Prepared statements are session-scoped, and pooled connections live for
+# the process, so each connection pays the parse/plan cost exactly once.
+_prepared_conns = weakref.WeakSet()
+
+def _ensure_prepared(conn):
+    """Prepare the hot-path INSERT statements once per pooled connection"""
+    if conn in _prepared_conns:
+        return
+    with conn.cursor() as cur:
         cur.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id SERIAL PRIMARY KEY,
-                document_id INTEGER NOT NULL,
-                user_query TEXT NOT NULL,
-                assistant_response TEXT NOT NULL,
-                timestamp TIMESTAMP NOT NULL,
-                FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
-            )
+            PREPARE ins_chat (int, text, text, timestamp) AS
+            INSERT INTO chat_history
+            (document_id, user_query, assistant_response, timestamp)
+            VALUES ($1, $2, $3, $4)
         ''')
-        print("Created chat_history table")
-        
-        conn.commit()
-        print("Database setup completed successfully")
-    except Exception as e:
-        conn.rollback()
-        print(f"Error setting up database: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
-
-def save_document(filename, document_text, document_analysis=None):
-    """Save document and its analysis to the database"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        # Extract document analysis data if available
-        document_type = None
-        summary = None
-        key_information = None
-        
-        if document_analysis:
-            document_type = document_analysis.get("document_type")
-            summary = document_analysis.get("summary")
-            key_information = json.dumps(document_analysis.get("key_information", {}))
-        
-        # Insert document
         cur.execute('''
-            INSERT INTO documents 
-            (filename, document_type, upload_date, document_text, summary, key_information)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            PREPARE ins_doc (text, text, timestamp, text, text, jsonb, bytea) AS
+            INSERT INTO documents
+            (filename, document_type, upload_date, document_text, summary, key_information, embeddings)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
             RETURNING id
-        ''', (filename, document_type, datetime.now(), document_text, summary, key_information))
-        
-        result = cur.fetchone()
-        document_id = result['id'] if result else None
-        conn.commit()
-        return document_id
-    except Exception as e:
-        conn.rollback()
-        print(f"Error saving document: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
+        ''')
+    conn.commit()
+    _prepared_conns.add(conn)
+
+def setup_database():
+    """Create necessary tables if they don't exist"""
+    with get_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                print("Setting up database tables...")
+
+                # Create documents table
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS documents (
+                        id SERIAL PRIMARY KEY,
+                        filename TEXT NOT NULL,
+                        document_type TEXT,
+                        upload_date TIMESTAMP NOT NULL,
+                        document_text TEXT NOT NULL,
+                        summary TEXT,
+                        key_information JSONB,
+                        embeddings BYTEA
+                    )
+                ''')
+                # Add the embeddings column to tables created before it existed
+                cur.execute('''
+                    ALTER TABLE documents ADD COLUMN IF NOT EXISTS embeddings BYTEA
+                ''')
+                print("Created documents table")
+
+                # Create entities table
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS entities (
+                        id SERIAL PRIMARY KEY,
+                        document_id INTEGER NOT NULL,
+                        entity_text TEXT NOT NULL,
+                        entity_type TEXT NOT NULL,
+                        start_pos INTEGER,
+                        end_pos INTEGER,
+                        FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
+                    )
+                ''')
+                print("Created entities table")
+
+                # Create chat_history table
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS chat_history (
+                        id SERIAL PRIMARY KEY,
+                        document_id INTEGER NOT NULL,
+                        user_query TEXT NOT NULL,
+                        assistant_response TEXT NOT NULL,
+                        timestamp TIMESTAMP NOT NULL,
+                        FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
+                    )
+                ''')
+                print("Created chat_history table")
+
+                # Postgres doesn't index foreign keys automatically; without
+                # these, the per-document entity/history lookups and the
+                # CASCADE delete all degrade to sequential scans. The
+                # composite index also serves get_chat_history's
+                # ORDER BY timestamp DESC ... LIMIT as an ordered scan.
+                cur.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_entities_document_id
+                    ON entities(document_id)
+                ''')
+                cur.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_chat_history_doc_ts
+                    ON chat_history(document_id, timestamp DESC)
+                ''')
+                print("Created foreign key indexes")
+
+            conn.commit()
+            print("Database setup completed successfully")
+        except Exception as e:
+            conn.rollback()
+            print(f"Error setting up database: {e}")
+            raise
+
+def save_document(filename, document_text, document_analysis=None, embeddings_blob=None):
+    """Save document, its analysis and its embeddings to the database"""
+    with get_conn() as conn:
+        try:
+            # Extract document analysis data if available
+            document_type = None
+            summary = None
+            key_information = None
+
+            if document_analysis:
+                document_type = document_analysis.get("document_type")
+                summary = document_analysis.get("summary")
+                # The Json adapter binds dicts to JSONB directly, skipping a
+                # manual json.dumps pass
+                key_information = Json(document_analysis.get("key_information", {}))
+
+            _ensure_prepared(conn)
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Insert document through the prepared statement, skipping
+                # parse+plan on warm connections
+                cur.execute(
+                    'EXECUTE ins_doc (%s, %s, %s, %s, %s, %s, %s)',
+                    (filename, document_type, datetime.now(), document_text, summary, key_information, embeddings_blob))
+
+                result = cur.fetchone()
+                document_id = result['id'] if result else None
+            conn.commit()
+            return document_id
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving document: {e}")
+            raise
+
+# Above this row count COPY's bulk-ingest path beats multi-row INSERTs
+COPY_MIN_ENTITIES = 500
 
 def save_entities(document_id, entities):
     """Save extracted entities to the database"""
     if not entities:
         return
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    try:
-        for entity in entities:
-            cur.execute('''
-                INSERT INTO entities 
-                (document_id, entity_text, entity_type, start_pos, end_pos)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (
-                document_id, 
-                entity["text"], 
-                entity["type"], 
-                entity.get("start", 0), 
-                entity.get("end", 0)
-            ))
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error saving entities: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
+
+    rows = [
+        (
+            document_id,
+            entity["text"],
+            entity["type"],
+            entity.get("start", 0),
+            entity.get("end", 0)
+        )
+        for entity in entities
+    ]
+
+    with get_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                if len(rows) >= COPY_MIN_ENTITIES:
+                    # Bulk loads go through COPY, which skips per-statement
+                    # parse/plan work and batches WAL writes. Entities are
+                    # re-derivable from the document, so relaxing commit
+                    # durability for this transaction is safe.
+                    cur.execute("SET LOCAL synchronous_commit = off")
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows(rows)
+                    buffer.seek(0)
+                    cur.copy_expert('''
+                        COPY entities
+                        (document_id, entity_text, entity_type, start_pos, end_pos)
+                        FROM STDIN WITH (FORMAT csv)
+                    ''', buffer)
+                else:
+                    # One multi-row INSERT instead of a round-trip per
+                    # entity; pages of ~1000 rows are where Postgres
+                    # ingest plateaus
+                    execute_values(cur, '''
+                        INSERT INTO entities
+                        (document_id, entity_text, entity_type, start_pos, end_pos)
+                        VALUES %s
+                    ''', rows, page_size=1000)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving entities: {e}")
+            raise
 
 def save_chat_interaction(document_id, user_query, assistant_response):
     """Save a chat interaction to the database"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    try:
-        cur.execute('''
-            INSERT INTO chat_history 
-            (document_id, user_query, assistant_response, timestamp)
-            VALUES (%s, %s, %s, %s)
-        ''', (document_id, user_query, assistant_response, datetime.now()))
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error saving chat interaction: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
-
-def get_document_by_id(document_id):
-    """Retrieve a document and its analysis by ID"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        # Get document
-        cur.execute('''
-            SELECT * FROM documents WHERE id = %s
-        ''', (document_id,))
-        
-        document = cur.fetchone()
-        
-        if not document:
-            return None
-        
-        # Parse JSON data
-        if document.get('key_information'):
-            document['key_information'] = json.loads(document['key_information'])
-        else:
-            document['key_information'] = {}
-            
-        # Get entities
-        cur.execute('''
-            SELECT * FROM entities WHERE document_id = %s
-        ''', (document_id,))
-        
-        entities = cur.fetchall()
-        document['entities'] = entities
-        
-        return document
-    except Exception as e:
-        print(f"Error retrieving document: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
+    with get_conn() as conn:
+        try:
+            _ensure_prepared(conn)
+            with conn.cursor() as cur:
+                cur.execute(
+                    'EXECUTE ins_chat (%s, %s, %s, %s)',
+                    (document_id, user_query, assistant_response, datetime.now()))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving chat interaction: {e}")
+            raise
+
+def get_document_by_id(document_id, include_text=False):
+    """
+    Retrieve a document and its analysis by ID. The document text and
+    embeddings are by far the largest columns, so they are only shipped
+    when include_text is set.
+    """
+    doc_columns = ("d.id, d.filename, d.document_type, d.upload_date, "
+                   "d.summary, d.key_information")
+    if include_text:
+        doc_columns += ", d.document_text, d.embeddings"
+
+    with get_conn() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Get the document and its entities in one round-trip;
+                # Postgres assembles the entity array server-side with
+                # json_agg instead of a second query
+                cur.execute(f'''
+                    SELECT {doc_columns},
+                           COALESCE(
+                               json_agg(e.*) FILTER (WHERE e.id IS NOT NULL),
+                               '[]'
+                           ) AS entities
+                    FROM documents d
+                    LEFT JOIN entities e ON e.document_id = d.id
+                    WHERE d.id = %s
+                    GROUP BY d.id
+                ''', (document_id,))
+
+                document = cur.fetchone()
+
+                if not document:
+                    return None
+
+                # psycopg2 already decodes JSONB columns to dicts
+                if not document.get('key_information'):
+                    document['key_information'] = {}
+
+                return document
+        except Exception as e:
+            print(f"Error retrieving document: {e}")
+            raise
+
+# Histories longer than this stream through a named server-side cursor
+# instead of materializing everything in the driver at once
+CHAT_HISTORY_STREAM_THRESHOLD = 100
 
 def get_chat_history(document_id, limit=10):
-    """Retrieve chat history for a document"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        cur.execute('''
-            SELECT * FROM chat_history 
-            WHERE document_id = %s
-            ORDER BY timestamp DESC
-            LIMIT %s
-        ''', (document_id, limit))
-        
-        history = cur.fetchall()
-        return history
-    except Exception as e:
-        print(f"Error retrieving chat history: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
+    """
+    Retrieve chat history for a document, most recent first. Small limits
+    fetch directly (the composite (document_id, timestamp DESC) index makes
+    this an ordered index scan); long histories — or limit=None for the
+    full history — stream through a server-side cursor so the driver holds
+    at most itersize rows at a time.
+    """
+    with get_conn() as conn:
+        try:
+            if limit is not None and limit <= CHAT_HISTORY_STREAM_THRESHOLD:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute('''
+                        SELECT id, user_query, assistant_response, timestamp
+                        FROM chat_history
+                        WHERE document_id = %s
+                        ORDER BY timestamp DESC
+                        LIMIT %s
+                    ''', (document_id, limit))
+
+                    history = cur.fetchall()
+                    return history
+
+            with conn.cursor("chat_history_cursor",
+                             cursor_factory=RealDictCursor) as cur:
+                cur.itersize = 100
+                cur.execute('''
+                    SELECT id, user_query, assistant_response, timestamp
+                    FROM chat_history
+                    WHERE document_id = %s
+                    ORDER BY timestamp DESC
+                    LIMIT %s
+                ''', (document_id, limit))
+
+                return list(cur)
+        except Exception as e:
+            print(f"Error retrieving chat history: {e}")
+            raise
 
 def list_documents(limit=10):
     """List all documents in the database"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        cur.execute('''
-            SELECT id, filename, document_type, upload_date, summary 
-            FROM documents
-            ORDER BY upload_date DESC
-            LIMIT %s
-        ''', (limit,))
-        
-        documents = cur.fetchall()
-        return documents
-    except Exception as e:
-        print(f"Error listing documents: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
+    with get_conn() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute('''
+                    SELECT id, filename, document_type, upload_date, summary
+                    FROM documents
+                    ORDER BY upload_date DESC
+                    LIMIT %s
+                ''', (limit,))
+
+                documents = cur.fetchall()
+                return documents
+        except Exception as e:
+            print(f"Error listing documents: {e}")
+            raise
 
 def delete_document(document_id):
     """Delete a document and all related data"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
+    with get_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                # Due to CASCADE constraint, this will delete related entities and chat history
+                cur.execute('''
+                    DELETE FROM documents WHERE id = %s
+                ''', (document_id,))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"Error deleting document: {e}")
+            raise
+
+# Initialize database tables when the module is imported, unless skipped.
+# The app already runs setup once per process via st.cache_resource, so
+# worker processes can set SKIP_DB_SETUP_ON_IMPORT=1 to avoid re-running DDL
+# on every import.
+if os.environ.get("SKIP_DB_SETUP_ON_IMPORT") != "1":
     try:
-        # Due to CASCADE constraint, this will delete related entities and chat history
-        cur.execute('''
-            DELETE FROM documents WHERE id = %s
-        ''', (document_id,))
-        
-        conn.commit()
-        return True
+        print("Initializing database on module load...")
+        setup_database()
+        print("Database initialized successfully!")
     except Exception as e:
-        conn.rollback()
-        print(f"Error deleting document: {e}")
-        raise
-    finally:
-        cur.close()
-        conn.close()
-
-# Initialize database tables when module is imported
-try:
-    print("Initializing database on module load...")
-    setup_database()
-    print("Database initialized successfully!")
-except Exception as e:
-    print(f"Error initializing database on module load: {e}")
\ No newline at end of file
+        print(f"Error initializing database on module load: {e}")
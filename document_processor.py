@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import PyPDF2
@@ -5,46 +6,55 @@ import docx
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from openai import OpenAI
 
+from utils import truncate_to_tokens
+
 # Initialize OpenAI client
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 openai = OpenAI(api_key=OPENAI_API_KEY)
 
-def extract_document_text(file_path):
+def extract_document_text(source, filename=None):
     """
-    Extract text from various document formats
+    Extract text from various document formats. Accepts either a file path
+    or a binary file-like object; for file-like sources the format is taken
+    from the filename argument, avoiding a temp-file write/read round-trip.
     """
-    file_extension = file_path.split('.')[-1].lower()
-    
+    name = source if isinstance(source, str) else filename
+    if not name:
+        raise ValueError("A filename is required for file-like sources")
+    file_extension = name.split('.')[-1].lower()
+
     if file_extension == 'pdf':
-        return extract_text_from_pdf(file_path)
+        return extract_text_from_pdf(source)
     elif file_extension == 'docx':
-        return extract_text_from_docx(file_path)
+        return extract_text_from_docx(source)
     elif file_extension == 'txt':
-        return extract_text_from_txt(file_path)
+        return extract_text_from_txt(source)
     else:
         raise ValueError(f"Unsupported file format: {file_extension}")
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF file"""
-    text = ""
-    with open(file_path, 'rb') as file:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text()
-    return text
-
-def extract_text_from_docx(file_path):
-    """Extract text from DOCX file"""
-    doc = docx.Document(file_path)
+def extract_text_from_pdf(source):
+    """Extract text from a PDF file path or binary stream"""
+    # PyPDF2 resolves page objects lazily through seek/read on the single
+    # underlying stream and is pure Python, so threading page extraction
+    # races on the stream without buying any CPU parallelism — pages are
+    # extracted sequentially. Join a generator instead of += on an
+    # immutable string, which copies the whole accumulator on every page.
+    pdf_reader = PyPDF2.PdfReader(source)
+    return "".join(page.extract_text() or "" for page in pdf_reader.pages)
+
+def extract_text_from_docx(source):
+    """Extract text from a DOCX file path or binary stream"""
+    doc = docx.Document(source)
     return "\n".join([paragraph.text for paragraph in doc.paragraphs])
 
-def extract_text_from_txt(file_path):
-    """Extract text from TXT file"""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        return file.read()
+def extract_text_from_txt(source):
+    """Extract text from a TXT file path or binary stream"""
+    if isinstance(source, str):
+        with open(source, 'r', encoding='utf-8') as file:
+            return file.read()
+    return source.read().decode('utf-8')
 
 def split_text_into_chunks(text, chunk_size=4000, overlap=200):
     """
@@ -80,13 +90,20 @@ def process_document(document_text):
         "key_information": key_info
     }
 
+# Token budgets for the document excerpts packed into each prompt, leaving
+# room for the instructions and the completion. Token-exact truncation
+# neither under-fills the budget (character slicing wastes ~4x on English
+# text) nor cuts mid-token.
+SUMMARY_INPUT_TOKENS = 3500
+DOCTYPE_INPUT_TOKENS = 3000
+KEY_INFO_INPUT_TOKENS = 3000
+
 def get_document_summary(document_text):
     """
     Generate a summary of the document using OpenAI
     """
     # Limit text length for the prompt
-    max_chars = 14000  # Limit to leave room for prompt and completion
-    truncated_text = document_text[:max_chars] if len(document_text) > max_chars else document_text
+    truncated_text = truncate_to_tokens(document_text, SUMMARY_INPUT_TOKENS)
     
     prompt = f"""
     Please provide a comprehensive summary of the following legal document. 
@@ -104,14 +121,52 @@ def get_document_summary(document_text):
     
     return response.choices[0].message.content
 
+# Optional local document-type classifier (a pickled TF-IDF + logistic
+# regression pipeline); when present and confident, it answers without the
+# LLM round-trip. The model file is not shipped with the repo, so the LLM
+# path remains the default.
+DOCTYPE_MODEL_PATH = os.path.join("models", "doctype.pkl")
+DOCTYPE_CONFIDENCE_THRESHOLD = 0.8
+_doctype_model = None
+_doctype_model_loaded = False
+
+def _get_doctype_model():
+    """Lazily load the local document-type classifier, if one is shipped"""
+    global _doctype_model, _doctype_model_loaded
+    if not _doctype_model_loaded:
+        _doctype_model_loaded = True
+        if os.path.exists(DOCTYPE_MODEL_PATH):
+            try:
+                import pickle
+                with open(DOCTYPE_MODEL_PATH, "rb") as f:
+                    _doctype_model = pickle.load(f)
+            except Exception as e:
+                print(f"Error loading document-type model: {e}")
+    return _doctype_model
+
 def determine_document_type(document_text):
     """
-    Determine the type of legal document using OpenAI
+    Determine the type of legal document, using the local classifier when
+    it is confident and falling back to OpenAI otherwise
     """
     # Limit text length for the prompt
-    max_chars = 12000  # Limit to leave room for prompt and completion
-    truncated_text = document_text[:max_chars] if len(document_text) > max_chars else document_text
-    
+    truncated_text = truncate_to_tokens(document_text, DOCTYPE_INPUT_TOKENS)
+
+    # Try the local classifier first; only low-confidence documents pay
+    # for the LLM call
+    model = _get_doctype_model()
+    if model is not None:
+        try:
+            probabilities = model.predict_proba([truncated_text])[0]
+            best = probabilities.argmax()
+            if probabilities[best] >= DOCTYPE_CONFIDENCE_THRESHOLD:
+                return json.dumps({
+                    "document_type": str(model.classes_[best]),
+                    "explanation": "Classified locally from characteristic document vocabulary."
+                })
+        except Exception as e:
+            print(f"Error running document-type model: {e}")
+
     prompt = f"""
     Based on the following legal document, identify the specific type of legal document it is 
     (e.g., contract, NDA, employment agreement, terms of service, privacy policy, patent, 
@@ -144,8 +199,7 @@ def extract_key_information(document_chunks, document_type):
     
     # Process first chunk as it usually contains the most important information
     first_chunk = document_chunks[0]
-    max_chars = 12000  # Limit to leave room for prompt and completion
-    truncated_text = first_chunk[:max_chars] if len(first_chunk) > max_chars else first_chunk
+    truncated_text = truncate_to_tokens(first_chunk, KEY_INFO_INPUT_TOKENS)
     
     prompt = f"""
     You are analyzing a {doc_type_label}. 
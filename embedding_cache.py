@@ -0,0 +1,28 @@
+import hashlib
+from functools import lru_cache
+
+from vector_store import get_embedding
+
+def normalize_question(text):
+    """Normalize question text so trivial variations share a cache entry"""
+    return text.strip().lower()
+
+@lru_cache(maxsize=256)
+def _embed_query(text_hash, text):
+    """Embed a query, memoized by the SHA-256 of its normalized text"""
+    return get_embedding(text)
+
+def get_query_embedding(question):
+    """Get the embedding vector for a query, reusing cached results for repeated questions"""
+    normalized = normalize_question(question)
+    text_hash = hashlib.sha256(normalized.encode()).hexdigest()
+    return _embed_query(text_hash, normalized)
+
+def get_cache_stats():
+    """Return hit/miss statistics for the query embedding cache"""
+    info = _embed_query.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize
+    }
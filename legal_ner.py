@@ -1,17 +1,34 @@
 import os
 import spacy
 import re
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 
+from utils import truncate_to_tokens
+
+# Token budget for the excerpt sent to the LLM entity pass, leaving room
+# for the instructions and the JSON completion
+NER_INPUT_TOKENS = 2500
+
+# Try to load pyahocorasick for single-pass multi-pattern matching; the
+# per-entity regex scan is used as a fallback
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # Initialize OpenAI client
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 openai = OpenAI(api_key=OPENAI_API_KEY)
 
-# Try to load SpaCy model
+# Try to load SpaCy model. Only the NER component is used, so the rest of
+# the pipeline is disabled for a faster load and higher throughput.
 try:
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load("en_core_web_sm",
+                     disable=["tagger", "parser", "lemmatizer",
+                              "attribute_ruler"])
 except:
     # If not installed, use a smaller model or just initialize
     nlp = spacy.blank("en")
@@ -30,14 +47,15 @@ legal_patterns = {
     "DATE": r'\d{1,2}/\d{1,2}/\d{2,4}|\d{1,2}-\d{1,2}-\d{2,4}|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{1,2},? \d{4}',
 }
 
-def extract_legal_entities(text):
-    """
-    Extract legal entities from text using both SpaCy and custom patterns
-    """
+# Compile the patterns once at import into a single alternation of named
+# groups, so each document is scanned once instead of once per pattern
+_COMBINED_LEGAL_PATTERN = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in legal_patterns.items())
+)
+
+def _entities_from_doc(doc):
+    """Collect the relevant entity spans from a parsed SpaCy doc"""
     entities = []
-    
-    # Use SpaCy for basic NER
-    doc = nlp(text)
     for ent in doc.ents:
         if ent.label_ in ["PERSON", "ORG", "GPE", "DATE", "MONEY"]:
             entities.append({
@@ -46,33 +64,68 @@ def extract_legal_entities(text):
                 "end": ent.end_char,
                 "type": ent.label_
             })
-    
-    # Use regex patterns for specific legal entities
-    for entity_type, pattern in legal_patterns.items():
-        for match in re.finditer(pattern, text):
-            entities.append({
-                "text": match.group(),
-                "start": match.start(),
-                "end": match.end(),
-                "type": entity_type
-            })
-    
-    # Use OpenAI for advanced legal entity recognition
-    openai_entities = extract_legal_entities_with_llm(text)
-    
-    # Combine all entities and remove duplicates
-    all_entities = entities + openai_entities
+    return entities
+
+def _spacy_entities(text):
+    """Use SpaCy for basic NER"""
+    return _entities_from_doc(nlp(text))
+
+def _regex_entities(text):
+    """Use regex patterns for specific legal entities"""
+    entities = []
+    for match in _COMBINED_LEGAL_PATTERN.finditer(text):
+        # Exactly one top-level named group matches per hit; the inner
+        # groups inside the patterns are unnamed, so resolve the entity
+        # type through groupdict
+        entity_type = next(name for name, value in match.groupdict().items()
+                           if value is not None)
+        entities.append({
+            "text": match.group(),
+            "start": match.start(),
+            "end": match.end(),
+            "type": entity_type
+        })
+    return entities
+
+def extract_legal_entities(text):
+    """
+    Extract legal entities from text using both SpaCy and custom patterns
+    """
+    # The three producers are independent: the OpenAI call is the tall pole
+    # and SpaCy releases the GIL in its C extensions, so running them in a
+    # thread pool brings total time to roughly max(LLM, SpaCy) not the sum
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        spacy_future = executor.submit(_spacy_entities, text)
+        regex_future = executor.submit(_regex_entities, text)
+        llm_future = executor.submit(extract_legal_entities_with_llm, text)
+
+        all_entities = (spacy_future.result() + regex_future.result() +
+                        llm_future.result())
+
+    # Remove duplicates and overlaps across the combined results
     unique_entities = remove_duplicate_entities(all_entities)
-    
+
     return unique_entities
 
+def extract_legal_entities_batch(texts, batch_size=32):
+    """
+    Extract legal entities from multiple texts at once, streaming them
+    through nlp.pipe so SpaCy batches its inference instead of parsing one
+    document at a time
+    """
+    results = []
+    for text, doc in zip(texts, nlp.pipe(texts, batch_size=batch_size)):
+        all_entities = (_entities_from_doc(doc) + _regex_entities(text) +
+                        extract_legal_entities_with_llm(text))
+        results.append(remove_duplicate_entities(all_entities))
+    return results
+
 def extract_legal_entities_with_llm(text):
     """
     Use OpenAI to extract legal entities that might be missed by SpaCy
     """
-    # For long texts, extract from first 10,000 characters only
-    max_chars = 10000
-    truncated_text = text[:max_chars] if len(text) > max_chars else text
+    # For long texts, extract from the leading tokens only
+    truncated_text = truncate_to_tokens(text, NER_INPUT_TOKENS)
     
     prompt = f"""
     Extract and identify legal entities from the following legal text. Focus on:
@@ -112,21 +165,7 @@ def extract_legal_entities_with_llm(text):
         entities = entities_data.get("entities", [])
         
         # Add start and end positions
-        processed_entities = []
-        for entity in entities:
-            entity_text = entity.get("text", "")
-            entity_type = entity.get("type", "LEGAL_TERM")
-            
-            # Find all occurrences of this entity in the text
-            for match in re.finditer(re.escape(entity_text), text):
-                processed_entities.append({
-                    "text": entity_text,
-                    "start": match.start(),
-                    "end": match.end(),
-                    "type": entity_type
-                })
-                
-        return processed_entities
+        return _locate_entities(entities, text)
     except json.JSONDecodeError:
         print("Error decoding JSON from OpenAI response")
         return []
@@ -134,6 +173,54 @@ def extract_legal_entities_with_llm(text):
         print(f"Error processing entities: {e}")
         return []
 
+def _locate_entities(entities, text):
+    """
+    Find every occurrence of each LLM-returned entity in the text. With
+    pyahocorasick this is one linear scan over the document for all
+    patterns at once, instead of one full-text regex pass per entity.
+    """
+    processed_entities = []
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        word_count = 0
+        for entity in entities:
+            entity_text = entity.get("text", "")
+            if entity_text:
+                automaton.add_word(
+                    entity_text,
+                    (entity_text, entity.get("type", "LEGAL_TERM")))
+                word_count += 1
+        if word_count == 0:
+            return processed_entities
+        automaton.make_automaton()
+
+        for end_index, (entity_text, entity_type) in automaton.iter(text):
+            start = end_index - len(entity_text) + 1
+            processed_entities.append({
+                "text": entity_text,
+                "start": start,
+                "end": end_index + 1,
+                "type": entity_type
+            })
+        return processed_entities
+
+    # Fallback: one regex pass per entity
+    for entity in entities:
+        entity_text = entity.get("text", "")
+        entity_type = entity.get("type", "LEGAL_TERM")
+
+        # Find all occurrences of this entity in the text
+        for match in re.finditer(re.escape(entity_text), text):
+            processed_entities.append({
+                "text": entity_text,
+                "start": match.start(),
+                "end": match.end(),
+                "type": entity_type
+            })
+
+    return processed_entities
+
 def remove_duplicate_entities(entities):
     """
     Remove duplicate or overlapping entities, preferring more specific types
@@ -158,35 +245,30 @@ def remove_duplicate_entities(entities):
         "MONEY": 0,
     }
     
-    # Filter out overlapping entities
+    # Filter out overlapping entities with a single sweep: the list is
+    # sorted by start, so accepted intervals stay ordered and a candidate
+    # can only collide with the most recently accepted one. This replaces
+    # the quadratic scan over all occupied ranges.
     unique_entities = []
-    occupied_ranges = []
-    
+    last_end = -1
+    last_priority = -1
+
     for entity in sorted_entities:
         start = entity["start"]
         end = entity["end"]
         entity_type = entity["type"]
         priority = type_priority.get(entity_type, 0)
-        
-        # Check for overlaps
-        overlap = False
-        for i, (occ_start, occ_end, occ_priority) in enumerate(occupied_ranges):
-            if not (end <= occ_start or start >= occ_end):
-                # There is an overlap
-                overlap = True
-                # If current entity has higher priority, replace the existing one
-                if priority > occ_priority:
-                    # Remove the existing entity
-                    occupied_ranges[i] = (start, end, priority)
-                    # Find and remove the corresponding entity
-                    for j, existing_entity in enumerate(unique_entities):
-                        if existing_entity["start"] == occ_start and existing_entity["end"] == occ_end:
-                            unique_entities[j] = entity
-                            break
-                break
-        
-        if not overlap:
+
+        if start >= last_end:
+            # No overlap with the previously accepted entity
             unique_entities.append(entity)
-            occupied_ranges.append((start, end, priority))
-    
+            last_end = end
+            last_priority = priority
+        elif priority > last_priority:
+            # Overlaps a lower-priority entity: replace it
+            unique_entities[-1] = entity
+            last_end = end
+            last_priority = priority
+        # Otherwise drop the lower-priority overlapping entity
+
     return unique_entities
@@ -1,6 +1,32 @@
 import re
 import html
 
+# tiktoken gives exact token counts for the models in use; fall back to a
+# character heuristic when it isn't available
+try:
+    import tiktoken
+    _encoding = tiktoken.encoding_for_model("gpt-4o")
+except Exception:
+    _encoding = None
+
+# Rough characters-per-token ratio for English text, used in the fallback
+CHARS_PER_TOKEN = 4
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Truncate text to a token budget, cutting on token boundaries so the
+    model never sees a partial token
+    """
+    if _encoding is not None:
+        tokens = _encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return _encoding.decode(tokens[:max_tokens])
+
+    # Approximate fallback when tiktoken isn't installed
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[:max_chars]
+
 def highlight_entities_in_text(text, entities):
     """
     Highlight entities in text with different colors based on entity type
@@ -25,33 +51,38 @@ def highlight_entities_in_text(text, entities):
     
     # Default color for unknown entity types
     default_color = "#9E9E9E"  # Gray
-    
-    # Sort entities by start position in reverse order
-    # This ensures that we process entities from the end of the text first
-    # to avoid issues with changing text positions
-    sorted_entities = sorted(entities, key=lambda x: x["start"], reverse=True)
-    
-    # Convert text to HTML-safe
-    html_text = html.escape(text)
-    
-    # Insert highlighting spans
+
+    # Entities are non-overlapping after deduplication, so sort by start
+    # and stitch the output in one left-to-right pass, escaping each
+    # segment as it is emitted. This replaces the per-entity string
+    # re-slicing (a full copy of the document per entity) with a single
+    # walk, and keeps entity offsets aligned with the raw text instead of
+    # the escaped version.
+    sorted_entities = sorted(entities, key=lambda x: x["start"])
+
+    pieces = []
+    position = 0
     for entity in sorted_entities:
         start = entity["start"]
         end = entity["end"]
+        if start < position:
+            # Skip anything overlapping an already-emitted span
+            continue
         entity_type = entity["type"]
         entity_text = html.escape(text[start:end])
-        
+
         # Get color for entity type
         color = entity_colors.get(entity_type, default_color)
-        
-        # Create highlighted span
-        highlighted_span = f'<span style="background-color: {color}; padding: 2px; border-radius: 3px;" title="{entity_type}">{entity_text}</span>'
-        
-        # Insert span into text
-        html_text = html_text[:start] + highlighted_span + html_text[end:]
-    
-    # Convert newlines to <br> tags
-    html_text = html_text.replace('\n', '<br>')
+
+        pieces.append(html.escape(text[position:start]))
+        pieces.append(
+            f'<span style="background-color: {color}; padding: 2px; border-radius: 3px;" title="{entity_type}">{entity_text}</span>'
+        )
+        position = end
+    pieces.append(html.escape(text[position:]))
+
+    # Convert newlines to <br> tags, once, on the assembled string
+    html_text = "".join(pieces).replace('\n', '<br>')
     
     # Wrap in div for styling
     return f'<div style="font-family: monospace; white-space: pre-wrap; line-height: 1.5;">{html_text}</div>'
@@ -1,9 +1,94 @@
 import os
+import hashlib
+import io
+from functools import lru_cache
 import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import faiss
 from openai import OpenAI
 
+# Try to load hnswlib for logarithmic-time search on large documents
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Below this many chunks no ANN index is built at all: a single BLAS-style
+# product over the normalized matrix outruns the Python/FFI overhead of an
+# index, and skips the build cost entirely
+NUMPY_MAX_CHUNKS = 2000
+
+# When FAISS is the fallback (no hnswlib), corpora this large graduate from
+# a flat scan to an IVF index with int8 scalar quantization
+FAISS_IVF_MIN_CHUNKS = 4096
+
+# Optional Numba-compiled scorer for the brute-force path; the plain NumPy
+# product is used when numba isn't installed
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _score_chunks_jit(matrix, query_vector):
+        scores = np.empty(matrix.shape[0], dtype=np.float32)
+        for i in prange(matrix.shape[0]):
+            total = 0.0
+            for j in range(matrix.shape[1]):
+                total += matrix[i, j] * query_vector[j]
+            scores[i] = total
+        return scores
+
+    # Warm the JIT cache so the first real query doesn't pay compilation
+    _score_chunks_jit(np.zeros((1, 2), dtype=np.float32),
+                      np.zeros(2, dtype=np.float32))
+except ImportError:
+    _score_chunks_jit = None
+
+# On-disk cache of document embedding matrices, keyed by content hash, so
+# re-loading a stored document skips the embedding API calls entirely
+EMBEDDING_CACHE_DIR = os.path.join("temp", "emb_cache")
+
+# In-process memo of recently built document embeddings for hot documents
+_document_cache = {}
+_DOCUMENT_CACHE_MAX_SIZE = 8
+
+def _quantize_matrix(matrix):
+    """Quantize an embedding matrix to int8 with a per-vector scale"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scale = np.abs(matrix).max(axis=1, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.round(matrix / scale).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+def _dequantize_matrix(quantized, scale):
+    """Restore a float32 embedding matrix from int8 values and scales"""
+    return quantized.astype(np.float32) * scale
+
+def _load_cached_matrix(text_hash, expected_chunks):
+    """Load a cached embedding matrix from disk, or None on miss"""
+    cache_path = os.path.join(EMBEDDING_CACHE_DIR, f"{text_hash}.npz")
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as data:
+            matrix = _dequantize_matrix(data["quantized"], data["scale"])
+    except Exception as e:
+        print(f"Error reading embedding cache: {e}")
+        return None
+    # Guard against stale entries from a different chunking configuration
+    if matrix.shape[0] != expected_chunks:
+        return None
+    return matrix
+
+def _store_cached_matrix(text_hash, embeddings_array):
+    """Persist an embedding matrix to the on-disk cache as int8"""
+    try:
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(EMBEDDING_CACHE_DIR, f"{text_hash}.npz")
+        quantized, scale = _quantize_matrix(embeddings_array)
+        np.savez_compressed(cache_path, quantized=quantized, scale=scale)
+    except Exception as e:
+        print(f"Error writing embedding cache: {e}")
+
 # Initialize OpenAI client
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
@@ -14,6 +99,11 @@ def create_document_embeddings(document_text):
     """
     Create embeddings for document chunks using OpenAI embeddings
     """
+    # Check the in-process cache first for hot documents
+    text_hash = hashlib.sha256(document_text.encode()).hexdigest()
+    if text_hash in _document_cache:
+        return _document_cache[text_hash]
+
     # Split the document into smaller chunks for embedding
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
@@ -21,34 +111,148 @@ def create_document_embeddings(document_text):
         length_function=len
     )
     document_chunks = text_splitter.split_text(document_text)
-    
-    # Get embeddings for each chunk
-    chunk_embeddings = []
-    for chunk in document_chunks:
-        embedding = get_embedding(chunk)
-        chunk_embeddings.append(embedding)
-    
-    # Create a FAISS index for fast similarity search
-    embeddings_array = np.array(chunk_embeddings).astype('float32')
-    
-    # Get dimension of embeddings
+
+    # Check the on-disk cache before hitting the embedding API
+    embeddings_array = _load_cached_matrix(text_hash, len(document_chunks))
+    if embeddings_array is None:
+        # Get embeddings for all chunks in batched API calls
+        chunk_embeddings = get_embeddings_batch(document_chunks)
+
+        embeddings_array = np.array(chunk_embeddings).astype('float32')
+        _store_cached_matrix(text_hash, embeddings_array)
+
+    # Keep a unit-normalized float16 copy for session state: half the memory
+    # and half the scan bandwidth of float32, in one contiguous matrix
+    norms = np.linalg.norm(embeddings_array, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normalized_matrix = (embeddings_array / norms).astype(np.float16)
+
+    # Build an index for fast similarity search
+    index, index_type = _build_index(embeddings_array, len(document_chunks))
+
+    document_embeddings = {
+        "index": index,
+        "index_type": index_type,
+        "chunks": document_chunks,
+        "embeddings": normalized_matrix
+    }
+
+    # Memoize for subsequent calls with the same document
+    if len(_document_cache) >= _DOCUMENT_CACHE_MAX_SIZE:
+        _document_cache.pop(next(iter(_document_cache)))
+    _document_cache[text_hash] = document_embeddings
+
+    return document_embeddings
+
+def _build_index(embeddings_array, num_chunks):
+    """
+    Build the search index for a chunk embedding matrix. Small documents get
+    no index at all (brute-force matrix product at query time); large ones
+    get an HNSW graph (O(log N) search), with FAISS as the fallback.
+    """
     dimension = embeddings_array.shape[1]
-    
-    # Initialize FAISS index
-    index = faiss.IndexFlatL2(dimension)
-    
-    # Add embeddings to the index
+
+    # Small documents skip index construction entirely;
+    # perform_document_search scores them with a direct matrix product
+    if num_chunks < NUMPY_MAX_CHUNKS:
+        return None, "numpy"
+
+    if hnswlib is not None:
+        index = hnswlib.Index(space='cosine', dim=dimension)
+        index.init_index(max_elements=num_chunks, M=16, ef_construction=100)
+        index.add_items(embeddings_array)
+        return index, "hnsw"
+
+    # Vectors are L2-normalized before indexing, so inner product equals
+    # cosine similarity and skips the squared-distance arithmetic of the L2
+    # metric
+    faiss.normalize_L2(embeddings_array)
+
+    if num_chunks >= FAISS_IVF_MIN_CHUNKS:
+        # Very large corpora get an inverted-file index with int8-quantized
+        # vectors: a quarter of the fp32 memory and only nprobe cells
+        # scanned per query instead of the whole matrix. Recall loss from
+        # the quantization is negligible for the k<=10 retrieval done here.
+        nlist = min(256, int(4 * np.sqrt(num_chunks)))
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit,
+            faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings_array)
+        index.add(embeddings_array)
+        index.nprobe = 8
+        return index, "faiss"
+
+    # The fp16 scalar quantizer halves index memory, which is the
+    # bottleneck for flat search
+    index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16,
+                                       faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings_array)
     index.add(embeddings_array)
-    
+    return index, "faiss"
+
+def serialize_embeddings(document_embeddings):
+    """
+    Serialize a document's embedding matrix to compressed bytes suitable for
+    storing alongside the document in the database
+    """
+    quantized, scale = _quantize_matrix(document_embeddings["embeddings"])
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, quantized=quantized, scale=scale)
+    return buffer.getvalue()
+
+def deserialize_embeddings(blob, document_text):
+    """
+    Rebuild document embeddings from stored bytes, re-splitting the text for
+    the chunks (cheap and deterministic) while skipping every embedding API
+    call. Returns None if the blob can't be used.
+    """
+    try:
+        with np.load(io.BytesIO(blob)) as data:
+            matrix = _dequantize_matrix(data["quantized"], data["scale"])
+    except Exception as e:
+        print(f"Error deserializing embeddings: {e}")
+        return None
+
+    chunks = split_text_for_embeddings(document_text)
+    # Guard against blobs written under a different chunking configuration
+    if matrix.shape[0] != len(chunks):
+        return None
+
+    index, index_type = _build_index(matrix, len(chunks))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
     return {
         "index": index,
-        "chunks": document_chunks,
-        "embeddings": embeddings_array
+        "index_type": index_type,
+        "chunks": chunks,
+        "embeddings": (matrix / norms).astype(np.float16)
     }
 
+# Number of inputs sent per embeddings API request, kept comfortably under
+# the API's per-request input and token ceilings
+EMBEDDING_BATCH_SIZE = 96
+
+def get_embeddings_batch(texts):
+    """
+    Get embedding vectors for a list of texts, batched into one API call
+    per EMBEDDING_BATCH_SIZE inputs instead of one call per text
+    """
+    embeddings = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[i:i + EMBEDDING_BATCH_SIZE]
+        response = openai.embeddings.create(
+            model="text-embedding-3-small",
+            input=batch
+        )
+        embeddings.extend(item.embedding for item in response.data)
+    return embeddings
+
+@lru_cache(maxsize=4096)
 def get_embedding(text):
     """
-    Get embedding vector for text using OpenAI embeddings
+    Get embedding vector for text using OpenAI embeddings. Memoized, so
+    repeated lookups for the same text never pay a second API round-trip.
     """
     response = openai.embeddings.create(
         model="text-embedding-3-small",
@@ -56,24 +260,51 @@ def get_embedding(text):
     )
     return response.data[0].embedding
 
-def perform_document_search(query, document_embeddings, full_text=None):
+def perform_document_search(query, document_embeddings, full_text=None, query_embedding=None):
     """
     Search for relevant document chunks based on query
     """
-    # Get embedding for the query
-    query_embedding = get_embedding(query)
+    # Get embedding for the query unless the caller already has one (e.g. from the cache)
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
     query_embedding_array = np.array([query_embedding]).astype('float32')
-    
+
     # Perform similarity search
     index = document_embeddings["index"]
     chunks = document_embeddings["chunks"]
-    
+
     # Get the top 3 most similar chunks
     k = min(3, len(chunks))
-    distances, indices = index.search(query_embedding_array, k)
-    
+    index_type = document_embeddings.get("index_type")
+    if index_type == "hnsw":
+        indices, distances = index.knn_query(query_embedding_array, k=k)
+        top_indices = indices[0]
+    elif index_type == "faiss":
+        # The flat index stores normalized vectors under the inner-product
+        # metric, so the query must be normalized too
+        faiss.normalize_L2(query_embedding_array)
+        distances, indices = index.search(query_embedding_array, k)
+        top_indices = indices[0]
+    else:
+        # Score every chunk with a single matrix-vector product over the
+        # normalized matrix, then select the top k with an O(N) partition
+        matrix = document_embeddings["embeddings"]
+        query_vector = query_embedding_array[0]
+        query_norm = np.linalg.norm(query_vector)
+        if query_norm > 0:
+            query_vector = query_vector / query_norm
+        if _score_chunks_jit is not None:
+            # Numba's CPU backend has no float16 support, so upcast for the
+            # parallel kernel (cheap at brute-force document sizes)
+            scores = _score_chunks_jit(matrix.astype(np.float32),
+                                       query_vector.astype(np.float32))
+        else:
+            scores = matrix @ query_vector.astype(matrix.dtype)
+        top_indices = np.argpartition(-scores, k - 1)[:k]
+        top_indices = top_indices[np.argsort(-scores[top_indices])]
+
     # Get the text of the most relevant chunks
-    relevant_chunks = [chunks[idx] for idx in indices[0]]
+    relevant_chunks = [chunks[idx] for idx in top_indices]
     
     if full_text and not relevant_chunks:
         # If no relevant chunks found or index is empty, return a portion of the full text